@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# ws_audio_server.py の再生キュー (PlaybackQueue) のテスト
+# pip install pytest してから python -m pytest で実行
+# ALSAデバイスは使わず、alsaaudio がなければ最低限のスタブに差し替える
+
+import sys
+import types
+
+import pytest
+
+try:
+    import alsaaudio  # noqa: F401
+except ImportError:
+    _stub = types.ModuleType("alsaaudio")
+    _stub.PCM_FORMAT_S16_LE = 2
+    _stub.PCM_CAPTURE = 1
+    _stub.PCM_PLAYBACK = 0
+    _stub.PCM_NONBLOCK = 1
+
+    class ALSAAudioError(Exception):
+        pass
+
+    _stub.ALSAAudioError = ALSAAudioError
+    sys.modules["alsaaudio"] = _stub
+
+import ws_audio_server
+from ws_audio_server import (
+    BYTES_PER_FRAME,
+    PERIOD_BYTES,
+    PERIOD_SIZE,
+    RATE,
+    SILENCE,
+    PlaybackQueue,
+)
+
+FD = 5
+
+
+class FakeHandle:
+    def __init__(self, when, callback):
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeLoop:
+    """
+    PlaybackQueue が使う分だけを実装したイベントループ。
+    時刻は advance() で進め、その時点までのタイマーを実行する。
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.handles = []
+        self.writers = {}
+
+    def time(self):
+        return self.now
+
+    def call_at(self, when, callback):
+        handle = FakeHandle(when, callback)
+        self.handles.append(handle)
+        return handle
+
+    def add_writer(self, fd, callback):
+        self.writers[fd] = callback
+
+    def remove_writer(self, fd):
+        self.writers.pop(fd, None)
+
+    def advance(self, seconds):
+        self.now += seconds
+        while True:
+            due = [h for h in self.handles if not h.cancelled and h.when <= self.now]
+            if not due:
+                break
+            for handle in due:
+                self.handles.remove(handle)
+                handle.callback()
+
+
+class FakePCM:
+    """
+    ノンブロッキングのALSA出力。空き (space) の分だけ書き込みを受け付ける。
+    avail() を持たない古い pyalsaaudio を想定する。
+    """
+
+    def __init__(self, space=10**9):
+        self.space = space
+        self.written = bytearray()
+        self.writes = []
+
+    def polldescriptors(self):
+        return [(FD, 0)]
+
+    def write(self, data):
+        frames = min(len(data) // BYTES_PER_FRAME, self.space)
+        self.space -= frames
+        self.written += bytes(data[:frames * BYTES_PER_FRAME])
+        self.writes.append(frames)
+        return frames
+
+
+class FakeAvailPCM(FakePCM):
+    """
+    avail() と info() を持つALSA出力。fill がデバイス内の再生待ちフレーム数。
+    """
+
+    def __init__(self, buffer_size=PERIOD_SIZE * 4, fill=0):
+        super().__init__()
+        self.buffer_size = buffer_size
+        self.fill = fill
+
+    def info(self):
+        return {"buffer_size": self.buffer_size}
+
+    def avail(self):
+        return self.buffer_size - self.fill
+
+    def write(self, data):
+        self.space = self.buffer_size - self.fill
+        frames = super().write(data)
+        self.fill += frames
+        return frames
+
+
+def make_queue(outp, maxlen=50):
+    loop = FakeLoop()
+    return loop, PlaybackQueue(outp, loop, maxlen)
+
+
+def test_feed_splits_into_periods():
+    outp = FakePCM()
+    loop, q = make_queue(outp)
+    # 4ピリオド + 128フレーム
+    data = bytes(range(256)) * 11
+    q.feed(data)
+    assert outp.written == data
+    assert outp.writes == [PERIOD_SIZE] * 4 + [128]
+    assert not q.chunks
+    assert not loop.writers
+
+
+def test_partial_write_waits_for_writable():
+    outp = FakePCM(space=100)
+    loop, q = make_queue(outp)
+    data = bytes(range(256)) * 5
+    q.feed(data)
+    # 書けなかった残りは先頭に戻り、書き込み可能通知を待つ
+    assert len(outp.written) == 100 * BYTES_PER_FRAME
+    assert len(q.chunks) == 2
+    assert len(q.chunks[0]) == PERIOD_BYTES - 100 * BYTES_PER_FRAME
+    assert FD in loop.writers
+
+    outp.space = 10**9
+    loop.writers[FD]()
+    assert outp.written == data
+    assert not q.chunks
+    assert not loop.writers
+
+
+def test_unaligned_message_drops_trailing_byte():
+    outp = FakePCM()
+    loop, q = make_queue(outp)
+    q.feed(b"\x01" * (PERIOD_BYTES + 1))
+    assert outp.written == b"\x01" * PERIOD_BYTES
+    assert not q.chunks
+    assert not loop.writers
+
+    # 1フレームに満たないメッセージは何も書かない
+    q.feed(b"\x02")
+    assert outp.written == b"\x01" * PERIOD_BYTES
+    assert not q.chunks
+    assert not loop.writers
+
+
+def test_sub_frame_head_chunk_is_dropped():
+    outp = FakePCM()
+    loop, q = make_queue(outp)
+    q.chunks.append(memoryview(b"\x01"))
+    q.chunks.append(memoryview(b"\x02" * PERIOD_BYTES))
+    q.drain()
+    assert outp.written == b"\x02" * PERIOD_BYTES
+    assert not q.chunks
+    assert not loop.writers
+
+
+def test_overflow_drops_oldest():
+    outp = FakePCM(space=0)
+    loop, q = make_queue(outp, maxlen=3)
+    periods = [bytes([i]) * PERIOD_BYTES for i in range(5)]
+    q.feed(b"".join(periods))
+    assert q.dropped == 2
+    assert [bytes(c) for c in q.chunks] == periods[2:]
+    assert FD in loop.writers
+
+
+def test_write_error_skips_chunk(capsys):
+    outp = FakePCM()
+
+    def write(data):
+        raise ws_audio_server.alsaaudio.ALSAAudioError("gone")
+
+    outp.write = write
+    loop, q = make_queue(outp)
+    q.feed(SILENCE * 2)
+    assert not q.chunks
+    assert not loop.writers
+    assert "ALSA書き込みエラー: gone" in capsys.readouterr().err
+
+
+def test_tick_pads_only_below_one_period():
+    outp = FakeAvailPCM(fill=PERIOD_SIZE)
+    loop, q = make_queue(outp)
+    # ちょうど1ピリオド残っていれば補填しない
+    loop.advance(ws_audio_server.PERIOD_SECONDS)
+    assert outp.writes == []
+    assert q.silence_fills == 0
+
+    outp.fill = PERIOD_SIZE - 1
+    loop.advance(ws_audio_server.PERIOD_SECONDS)
+    assert outp.writes == [PERIOD_SIZE]
+    assert q.silence_fills == 1
+
+
+def test_tick_does_not_pad_while_chunks_pending():
+    outp = FakeAvailPCM(buffer_size=PERIOD_SIZE * 2, fill=0)
+    loop, q = make_queue(outp)
+    q.feed(SILENCE * 3)
+    assert len(q.chunks) == 1
+    outp.fill = 0
+    loop.advance(ws_audio_server.PERIOD_SECONDS)
+    assert q.silence_fills == 0
+
+
+def test_tick_partial_silence_is_not_counted():
+    outp = FakeAvailPCM(buffer_size=PERIOD_SIZE + 100, fill=PERIOD_SIZE)
+    loop, q = make_queue(outp)
+    # avail() が嘘をついていても、一部しか書けなければ補填として数えない
+    outp.avail = lambda: PERIOD_SIZE * 4
+    loop.advance(ws_audio_server.PERIOD_SECONDS)
+    assert outp.writes == [100]
+    assert q.silence_fills == 0
+
+
+def test_tick_estimates_fill_without_avail():
+    # avail() がなければ書き込んだフレーム数と時刻から残量を見積もる
+    outp = FakePCM()
+    loop, q = make_queue(outp)
+    q.prefill_silence(2)
+    assert outp.writes == [PERIOD_SIZE, PERIOD_SIZE]
+
+    loop.advance(ws_audio_server.PERIOD_SECONDS)
+    # 残り1ピリオドなので補填しない
+    assert len(outp.writes) == 2
+
+    loop.advance(ws_audio_server.PERIOD_SECONDS)
+    # 空になったので補填する
+    assert len(outp.writes) == 3
+    assert q.silence_fills == 1
+    assert q.play_end == pytest.approx(loop.now + PERIOD_SIZE / RATE)
+
+
+def test_feed_resets_silence_run():
+    outp = FakePCM()
+    loop, q = make_queue(outp)
+    for _ in range(3):
+        loop.advance(ws_audio_server.PERIOD_SECONDS)
+    assert q.silence_run == 3
+    q.feed(SILENCE)
+    assert q.silence_run == 0
+
+
+def test_close_cancels_tick_and_writer():
+    outp = FakePCM(space=0)
+    loop, q = make_queue(outp)
+    q.feed(SILENCE)
+    assert FD in loop.writers
+    q.close()
+    assert q.tick_handle.cancelled
+    assert not loop.writers
+    assert not q.chunks
+    writes = len(outp.writes)
+    loop.advance(1.0)
+    assert len(outp.writes) == writes
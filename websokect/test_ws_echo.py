@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# ws_echo.py の RAWモード (RawEchoProtocol) のテスト
+# pip install pytest してから python -m pytest で実行
+
+import base64
+import hashlib
+import os
+
+import pytest
+
+import ws_echo
+from ws_echo import RawEchoProtocol, WS_GUID
+
+
+class FakeTransport:
+    """
+    RawEchoProtocol が使う分だけを実装したトランスポート。
+    書き込まれたバイト列を out に溜める。
+    """
+
+    def __init__(self):
+        self.out = bytearray()
+        self.closed = False
+        self.reading = True
+
+    def get_extra_info(self, name):
+        return ("127.0.0.1", 12345) if name == "peername" else None
+
+    def write(self, data):
+        self.out += data
+
+    def writelines(self, lines):
+        for data in lines:
+            self.out += data
+
+    def close(self):
+        self.closed = True
+
+    def is_closing(self):
+        return self.closed
+
+    def pause_reading(self):
+        self.reading = False
+
+    def resume_reading(self):
+        self.reading = True
+
+
+def client_frame(opcode, payload, fin=True):
+    """
+    クライアント->サーバ (マスクあり) のフレームを組み立てる。
+    """
+    b0 = (0x80 if fin else 0) | opcode
+    length = len(payload)
+    if length < 126:
+        header = bytes((b0, 0x80 | length))
+    elif length < 0x10000:
+        header = bytes((b0, 0x80 | 126)) + length.to_bytes(2, "big")
+    else:
+        header = bytes((b0, 0x80 | 127)) + length.to_bytes(8, "big")
+    mask = os.urandom(4)
+    masked = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+    return header + mask + masked
+
+
+def server_frames(data):
+    """
+    サーバ->クライアント (マスクなし) のフレーム列を (b0, payload) のリストにする。
+    """
+    frames = []
+    pos = 0
+    while pos < len(data):
+        b0 = data[pos]
+        length = data[pos + 1] & 0x7F
+        pos += 2
+        if length == 126:
+            length = int.from_bytes(data[pos:pos + 2], "big")
+            pos += 2
+        elif length == 127:
+            length = int.from_bytes(data[pos:pos + 8], "big")
+            pos += 8
+        frames.append((b0, bytes(data[pos:pos + length])))
+        pos += length
+    return frames
+
+
+@pytest.fixture
+def conn():
+    """
+    ハンドシェイク済みのプロトコルとトランスポートを返す。
+    """
+    proto = RawEchoProtocol()
+    transport = FakeTransport()
+    proto.connection_made(transport)
+    key = base64.b64encode(os.urandom(16))
+    proto.data_received(
+        b"GET / HTTP/1.1\r\n"
+        b"Host: localhost\r\n"
+        b"Upgrade: websocket\r\n"
+        b"Connection: Upgrade\r\n"
+        b"Sec-WebSocket-Key: " + key + b"\r\n"
+        b"Sec-WebSocket-Version: 13\r\n\r\n"
+    )
+    accept = base64.b64encode(hashlib.sha1(key + WS_GUID).digest())
+    assert transport.out.startswith(b"HTTP/1.1 101 ")
+    assert b"Sec-WebSocket-Accept: " + accept + b"\r\n" in transport.out
+    transport.out.clear()
+    return proto, transport
+
+
+def test_handshake_without_key_is_rejected():
+    proto = RawEchoProtocol()
+    transport = FakeTransport()
+    proto.connection_made(transport)
+    proto.data_received(b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    assert transport.out.startswith(b"HTTP/1.1 400 ")
+    assert transport.closed
+
+
+@pytest.mark.parametrize("length", [0, 125, 126, 640, 65535, 65536, 70000])
+def test_binary_echo_lengths(conn, length):
+    # 7bit / 16bit(126) / 64bit(127) の長さ表現の境界
+    proto, transport = conn
+    payload = os.urandom(length)
+    proto.data_received(client_frame(ws_echo.OP_BINARY, payload))
+    assert server_frames(transport.out) == [(0x82, payload)]
+    assert not proto.buf
+
+
+def test_frame_split_across_reads(conn):
+    # 1フレームが細切れに届いても揃った時点で処理する
+    proto, transport = conn
+    payload = os.urandom(70000)
+    data = client_frame(ws_echo.OP_BINARY, payload)
+    for i in range(0, len(data), 1000):
+        proto.data_received(data[i:i + 1000])
+    assert server_frames(transport.out) == [(0x82, payload)]
+
+
+def test_multiple_frames_in_one_read(conn):
+    proto, transport = conn
+    a = os.urandom(640)
+    b = os.urandom(300)
+    proto.data_received(client_frame(ws_echo.OP_BINARY, a) + client_frame(ws_echo.OP_BINARY, b))
+    assert server_frames(transport.out) == [(0x82, a), (0x82, b)]
+
+
+def test_binary_fragments_keep_fin_and_opcode(conn):
+    proto, transport = conn
+    proto.data_received(
+        client_frame(ws_echo.OP_BINARY, b"abc", fin=False)
+        + client_frame(ws_echo.OP_CONT, b"de", fin=False)
+        + client_frame(ws_echo.OP_CONT, b"f")
+    )
+    assert server_frames(transport.out) == [(0x02, b"abc"), (0x00, b"de"), (0x80, b"f")]
+    assert proto.fragment_opcode is None
+
+
+def test_text_fragments_are_joined(conn, capsys):
+    # TEXTはエコーせず、揃ってからprintする
+    proto, transport = conn
+    proto.data_received(client_frame(ws_echo.OP_TEXT, "MEDIA_".encode(), fin=False))
+    proto.data_received(client_frame(ws_echo.OP_CONT, "START あ".encode()))
+    assert transport.out == b""
+    assert "受信 (TEXT): MEDIA_START あ" in capsys.readouterr().out
+
+
+def test_ping_between_fragments(conn):
+    # 制御フレームはフラグメントの途中に挟まってもよい
+    proto, transport = conn
+    proto.data_received(
+        client_frame(ws_echo.OP_BINARY, b"ab", fin=False)
+        + client_frame(ws_echo.OP_PING, b"hello")
+        + client_frame(ws_echo.OP_CONT, b"cd")
+    )
+    assert server_frames(transport.out) == [(0x02, b"ab"), (0x8A, b"hello"), (0x80, b"cd")]
+
+
+def test_close_echoes_code(conn):
+    proto, transport = conn
+    proto.data_received(
+        client_frame(ws_echo.OP_CLOSE, (1001).to_bytes(2, "big"))
+        + client_frame(ws_echo.OP_BINARY, b"ignored")
+    )
+    assert server_frames(transport.out) == [(0x88, (1001).to_bytes(2, "big"))]
+    assert transport.closed
+
+
+def test_close_without_code(conn):
+    proto, transport = conn
+    proto.data_received(client_frame(ws_echo.OP_CLOSE, b""))
+    assert server_frames(transport.out) == [(0x88, (1000).to_bytes(2, "big"))]
+    assert transport.closed
+
+
+def test_too_big_payload_closes_with_1009(conn):
+    proto, transport = conn
+    header = bytes((0x82, 0x80 | 127)) + (ws_echo.RAW_MAX_PAYLOAD + 1).to_bytes(8, "big")
+    proto.data_received(header)
+    assert server_frames(transport.out) == [(0x88, (1009).to_bytes(2, "big"))]
+    assert transport.closed
+
+
+def test_write_backpressure_pauses_reading(conn):
+    proto, transport = conn
+    proto.pause_writing()
+    assert not transport.reading
+    proto.resume_writing()
+    assert transport.reading
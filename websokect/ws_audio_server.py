@@ -2,13 +2,19 @@
 # Python3でvenv環境を使うこと
 # (alsaaudioがディストリのものでは挙動がおかしいため)
 # venv環境を用意して以下を実行
-# pip install --upgrade pyalsaaudio websockets
+# pip install --upgrade pyalsaaudio "websockets>=14" uvloop
 
 import alsaaudio
 import asyncio
+import collections
+import functools
+import os
+import threading
 import websockets
 import sys
 
+from ws_core import run, run_until_first_done, serve_forever
+
 # --- ALSAデバイス設定 (環境に合わせて変更) ---
 INPUT_DEVICE = 'plughw:1,0'  
 OUTPUT_DEVICE = 'plughw:1,0' 
@@ -21,15 +27,59 @@ FORMAT = alsaaudio.PCM_FORMAT_S16_LE  # slin (16ビット符号付きリトル
 # --- チャンクサイズ設定 (20ms固定) ---
 # 20msペーシングを守ること
 BYTES_PER_FRAME = (16 // 8) * CHANNELS
-PERIOD_SIZE = int(RATE * 0.020)
+PERIOD_SIZE = RATE * 20 // 1000
+PERIOD_BYTES = PERIOD_SIZE * BYTES_PER_FRAME
 
 # --- WebSocketサーバ設定 ---
 WEBSOCKET_HOST = '0.0.0.0' # すべてのIFで待ち受け
 WEBSOCKET_PORT = 8765      # 待ち受けポート
+# ソケットの送受信バッファサイズと送信バッファの上限 (どちらも4ピリオド分)
+# ここに溜まった分はそのまま遅延になるので小さくしておく
+# (溢れた分は送信待ちキューで古いものから捨てられる)
+# Linuxでは SO_SNDBUF に指定値の2倍が確保される
+SOCKET_BUFFER_SIZE = PERIOD_BYTES * 4
+WRITE_LIMIT = PERIOD_BYTES * 4
 
 # MEDIA_START受信後、ANSWERを送信するまでの遅延 (秒)
 ANSWER_DELAY = 3.0 
 
+# --- オーディオキュー設定 ---
+# ALSA読み取りとWebSocket送信タスク間のキュー長 (ピリオド数)
+# 溢れた場合は古いピリオドから捨てる
+READ_QUEUE_SIZE = 8
+# 捨てたピリオド数を報告する間隔 (秒)
+# 捨てたピリオドがあれば "AUDIO_DROP n" をTEXTで送りクライアントが欠落を検出できるようにする
+DROP_REPORT_INTERVAL = 1.0
+# ALSA出力へ書き込む前に溜めておける最大ピリオド数 (1秒分)
+# 溢れた場合は古いピリオドから捨てる
+PLAYBACK_QUEUE_SIZE = 50
+# 接続開始時にALSA出力へ先に書き込んでおく無音のピリオド数
+PREFILL_PERIODS = 2
+
+# 1ピリオド分の無音 (S16_LEの0)
+SILENCE = bytes(PERIOD_BYTES)
+# デバイスの残量を確認して無音で埋めるかを判断する間隔 (秒, 1ピリオド)
+PERIOD_SECONDS = PERIOD_SIZE / RATE
+# 無音補填がこのピリオド数続いたら警告を出す (1秒分)
+SILENCE_WARN_PERIODS = 50
+
+# --- リアルタイムスケジューリング設定 (Linux) ---
+# ALSAの読み書きはすべてイベントループのスレッドで行うので、指定があれば
+# このスレッドをSCHED_FIFOにし、専用CPUに固定してXRUNの原因になる遅延を抑える。
+# イベントループ全体 (WebSocket処理やprintも含む) とそこから作られるスレッドが
+# 対象になるため、どちらも明示的に指定した場合だけ有効にする。
+# SCHED_FIFOは CAP_SYS_NICE (またはroot) が必要。権限がなければ通常のスケジューリングのまま動く。
+# SCHED_FIFOにするか (環境変数 WS_AUDIO_RT=1 で有効)
+AUDIO_RT = os.getenv("WS_AUDIO_RT", "0") == "1"
+AUDIO_RT_PRIORITY = 20
+# 固定するCPU番号 (環境変数 WS_AUDIO_CPU で指定, 未指定なら固定しない)
+AUDIO_CPU = int(os.environ["WS_AUDIO_CPU"]) if os.getenv("WS_AUDIO_CPU") else None
+
+# 何ピリオド分をまとめて1フレームで送るか (環境変数 WS_BATCH で指定)
+# 大きくするとフレーム数(CPU負荷)は減るが、その分Asterisk側の再生遅延が増える
+# 対話用途では 1 (まとめない) のままにすること
+BATCH_PERIODS = max(1, int(os.getenv("WS_BATCH", "1")))
+
 
 print("--- オーディオ設定 ---")
 print(f"デバイス (IN): {INPUT_DEVICE}")
@@ -38,22 +88,290 @@ print(f"レート: {RATE} Hz")
 print(f"フォーマット: {FORMAT} (S16_LE)")
 print(f"チャンネル: {CHANNELS}")
 print(f"ピリオドサイズ: {PERIOD_SIZE} フレーム (={int(PERIOD_SIZE/RATE*1000)}ms)")
-print(f"チャンクサイズ: {PERIOD_SIZE * BYTES_PER_FRAME} バイト")
+print(f"チャンクサイズ: {PERIOD_BYTES} バイト")
 print(f"ANSWER遅延: {ANSWER_DELAY} 秒")
+print(f"送信まとめ数: {BATCH_PERIODS} ピリオド")
+print(f"オーディオCPU: {AUDIO_CPU if AUDIO_CPU is not None else '指定なし'}")
+print(f"SCHED_FIFO: {'有効' if AUDIO_RT else '無効'}")
 print("-" * 22)
 
 
+def set_audio_scheduling():
+    """
+    呼び出したスレッドを、指定があればAUDIO_CPUに固定し、AUDIO_RTならSCHED_FIFOに設定する。
+    権限がない場合などは警告を出してそのまま続行する。
+    """
+    if not hasattr(os, "sched_setscheduler"):
+        return
+    tid = threading.get_native_id()
+    if AUDIO_CPU is not None:
+        try:
+            os.sched_setaffinity(tid, {AUDIO_CPU})
+            print(f"オーディオスレッドをCPU {AUDIO_CPU} に固定しました。")
+        except OSError as e:
+            print(f"CPUの固定に失敗しました: {e}", file=sys.stderr)
+    if not AUDIO_RT:
+        return
+    try:
+        os.sched_setscheduler(tid, os.SCHED_FIFO, os.sched_param(AUDIO_RT_PRIORITY))
+        print(f"オーディオスレッドをSCHED_FIFO (優先度 {AUDIO_RT_PRIORITY}) にしました。")
+    except PermissionError:
+        print("SCHED_FIFOに設定できません (CAP_SYS_NICEが必要)。通常の優先度で動作します。")
+    except OSError as e:
+        print(f"SCHED_FIFOの設定に失敗しました: {e}", file=sys.stderr)
+
+
+def _put_drop_oldest(read_queue, item):
+    """
+    キューが満杯なら最も古い要素を捨ててから追加する。捨てた場合は True を返す。
+    (ALSAキャプチャは止められないので、送信が詰まったら古いものから捨てる)
+    """
+    dropped = False
+    if read_queue.full():
+        read_queue.get_nowait()
+        dropped = True
+    read_queue.put_nowait(item)
+    return dropped
+
+
+def _drain_capture(inp, loop, fds, read_queue, stats):
+    """
+    ALSA入力(inp)の読み取り可能通知 (loop.add_reader) で呼ばれるコールバック。
+    ノンブロッキングで読めるだけ読み、(length, data) をキューへ渡す。
+    キューが溢れて捨てたピリオド数を stats["dropped"] に加算する。
+    読み取りで例外が出た場合はfdの登録を外し、(-1, b"") を渡して送信タスクを終わらせる。
+    """
+    read = inp.read
+    while True:
+        try:
+            length, data = read()
+        except alsaaudio.ALSAAudioError as e:
+            print(f"ALSA読み取りエラー: {e}", file=sys.stderr)
+            # 外さないと読み取り可能通知のたびに同じ例外が出続ける
+            for fd in fds:
+                loop.remove_reader(fd)
+            length, data = -1, b""
+        if length == 0:
+            # 読めるデータがなくなった (EAGAIN)
+            break
+        if _put_drop_oldest(read_queue, (length, data)):
+            stats["dropped"] += 1
+        if length < 0:
+            break
+
+
+class PlaybackQueue:
+    """
+    ALSA出力(outp, PCM_NONBLOCK)へのピリオド単位の書き込みキュー。
+    受信データをピリオドごとに分割して溜め、デバイスに空きがある分だけ書き込む。
+    デバイスが一杯の間だけ loop.add_writer で書き込み可能通知を待つ。
+    1ピリオドごとのタイマーでデバイスの残量を確認し、受信が途切れて
+    1ピリオド未満になっていれば無音で埋める (アンダーランからの復帰処理をさせない)。
+    """
+
+    def __init__(self, outp, loop, maxlen):
+        self.outp = outp
+        self.loop = loop
+        self.chunks = collections.deque(maxlen=maxlen)
+        self.fds = [fd for fd, events in outp.polldescriptors()]
+        self.waiting = False
+        self.dropped = 0
+        # 残量は avail() があればデバイスから得る。なければ書き込んだフレーム数から
+        # デバイスが空になる時刻 (play_end) を見積もる
+        self.buffer_frames = None
+        if hasattr(outp, "avail") and hasattr(outp, "info"):
+            self.buffer_frames = outp.info()["buffer_size"]
+        self.play_end = loop.time()
+        self.silence_fills = 0
+        self.silence_run = 0
+        self.next_tick = loop.time() + PERIOD_SECONDS
+        self.tick_handle = loop.call_at(self.next_tick, self._tick)
+
+    def feed(self, data):
+        """
+        受信データをピリオドごとのビューに分割してキューに追加し、書き込む。
+        (まとめて届いたデータで1回の書き込みが長時間ブロックしないようにする)
+        フレーム境界に揃わない末尾のバイトは捨てる。
+        """
+        self.silence_run = 0
+        chunks = self.chunks
+        mv = memoryview(data)
+        mv = mv[:len(mv) - len(mv) % BYTES_PER_FRAME]
+        for off in range(0, len(mv), PERIOD_BYTES):
+            if len(chunks) == chunks.maxlen:
+                # dequeのmaxlenにより最も古いピリオドが捨てられる
+                self.dropped += 1
+            chunks.append(mv[off:off + PERIOD_BYTES])
+        self.drain()
+
+    def drain(self):
+        """
+        デバイスが受け付ける分だけ書き込む。
+        残りがあれば書き込み可能通知を待ち、なくなれば通知を止める。
+        """
+        chunks = self.chunks
+        write = self.outp.write
+        while chunks:
+            chunk = chunks[0]
+            if len(chunk) < BYTES_PER_FRAME:
+                # 1フレームに満たない断片は書けない (write が 0 を返し続ける) ので捨てる
+                chunks.popleft()
+                continue
+            try:
+                # アンダーラン(EPIPE)は pyalsaaudio 内で snd_pcm_recover される
+                n = write(chunk)
+            except alsaaudio.ALSAAudioError as e:
+                print(f"ALSA書き込みエラー: {e}", file=sys.stderr)
+                chunks.popleft()
+                continue
+            if n <= 0:
+                # デバイスのバッファが一杯 (EAGAIN)
+                break
+            self._written(n)
+            nbytes = n * BYTES_PER_FRAME
+            if nbytes < len(chunk):
+                # 一部だけ書けた場合は残りを先頭に戻す
+                chunks[0] = chunk[nbytes:]
+                break
+            chunks.popleft()
+        self._set_waiting(bool(chunks))
+
+    def prefill_silence(self, periods):
+        """
+        ALSA出力に無音を書き込んでおき、再生開始直後のアンダーランを防ぐ。
+        """
+        for _ in range(periods):
+            try:
+                n = self.outp.write(SILENCE)
+            except alsaaudio.ALSAAudioError as e:
+                print(f"ALSA書き込みエラー: {e}", file=sys.stderr)
+                break
+            if n <= 0:
+                break
+            self._written(n)
+
+    def _written(self, n):
+        """
+        nフレーム書き込んだ分だけ、デバイスが空になる見積もり時刻を進める。
+        """
+        now = self.loop.time()
+        if self.play_end < now:
+            self.play_end = now
+        self.play_end += n / RATE
+
+    def _queued_frames(self):
+        """
+        デバイスに残っている再生待ちのフレーム数を返す。
+        """
+        if self.buffer_frames is not None:
+            avail = self.outp.avail()
+            if avail < 0:
+                # アンダーラン中などはエラーコード (負) が返るので空として扱う
+                return 0
+            return max(0, self.buffer_frames - avail)
+        return max(0.0, self.play_end - self.loop.time()) * RATE
+
+    def _tick(self):
+        """
+        1ピリオドごとに呼ばれ、キューが空でデバイスの残量が1ピリオド未満なら
+        無音を1ピリオド書き込む。まだ再生待ちがあれば何もしない (遅延を足さない)。
+        """
+        if not self.chunks and self._queued_frames() < PERIOD_SIZE:
+            try:
+                n = self.outp.write(SILENCE)
+                if n > 0:
+                    self._written(n)
+                # 一部しか書けなかった場合は補填として数えない
+                if n == PERIOD_SIZE:
+                    self.silence_fills += 1
+                    self.silence_run += 1
+                    if self.silence_run == SILENCE_WARN_PERIODS:
+                        print(f"受信が途切れたため無音で補填しています ({self.silence_run} ピリオド連続)", file=sys.stderr)
+            except alsaaudio.ALSAAudioError as e:
+                print(f"ALSA書き込みエラー: {e}", file=sys.stderr)
+        # 遅れが積み重ならないように前回の予定時刻から次を決める
+        # (ループが大きく止まっていた場合は追いかけずに仕切り直す)
+        self.next_tick += PERIOD_SECONDS
+        now = self.loop.time()
+        if self.next_tick < now:
+            self.next_tick = now + PERIOD_SECONDS
+        self.tick_handle = self.loop.call_at(self.next_tick, self._tick)
+
+    def _set_waiting(self, waiting):
+        if waiting == self.waiting:
+            return
+        for fd in self.fds:
+            if waiting:
+                self.loop.add_writer(fd, self.drain)
+            else:
+                self.loop.remove_writer(fd)
+        self.waiting = waiting
+
+    def close(self):
+        self.tick_handle.cancel()
+        self._set_waiting(False)
+        self.chunks.clear()
+        if self.silence_fills:
+            print(f"無音で補填したピリオド数: {self.silence_fills}")
+        if self.dropped:
+            print(f"再生キューが溢れたため {self.dropped} ピリオドを破棄しました。", file=sys.stderr)
+
+
 async def alsa_to_websocket(websocket, inp):
     """
     ALSA入力(inp)からオーディオを読み取り、WebSocketに送信するタスク。
     """
     print("ALSA->WebSocket タスクを開始します。")
+    loop = asyncio.get_running_loop()
+    read_queue = asyncio.Queue(maxsize=READ_QUEUE_SIZE)
+    stats = {"dropped": 0}
+    dropped_total = 0
+    next_report = loop.time() + DROP_REPORT_INTERVAL
+
+    # inpはPCM_NONBLOCKで開いてあるので、ポーリング用fdをイベントループに登録し
+    # 読み取り可能になったらループ上で直接読む (スレッドを介さない)
+    fds = [fd for fd, events in inp.polldescriptors()]
+    for fd in fds:
+        loop.add_reader(fd, _drain_capture, inp, loop, fds, read_queue, stats)
+    # キャプチャは最初の読み取りで開始されるので一度呼んでおく
+    _drain_capture(inp, loop, fds, read_queue, stats)
+
+    # BATCH_PERIODS > 1 の場合に複数ピリオドをまとめる送信バッファ
+    batch = bytearray(BATCH_PERIODS * PERIOD_BYTES)
+    batch_fill = 0
+    batch_count = 0
+
+    # ループ内で毎回属性を引かないようにローカルに束縛しておく
+    get = read_queue.get
+    send = websocket.send
+    now = loop.time
+
     try:
         while True:
-            length, data = await asyncio.to_thread(inp.read)
+            length, data = await get()
+
+            # 一定間隔で捨てたピリオド数を報告する
+            if now() >= next_report:
+                next_report = now() + DROP_REPORT_INTERVAL
+                dropped = stats["dropped"]
+                if dropped:
+                    stats["dropped"] = 0
+                    dropped_total += dropped
+                    print(f"送信遅延のため {dropped} ピリオドを破棄 (累計 {dropped_total})", file=sys.stderr)
+                    await send(f"AUDIO_DROP {dropped}")
 
-            if length > 0:
-                await websocket.send(data)
+            if length > 0 and BATCH_PERIODS == 1:
+                # 読み取ったbytesをそのまま送る
+                await send(data)
+            elif length > 0:
+                nbytes = len(data)
+                batch[batch_fill:batch_fill + nbytes] = data
+                batch_fill += nbytes
+                batch_count += 1
+                if batch_count >= BATCH_PERIODS:
+                    await send(memoryview(batch)[:batch_fill])
+                    batch_fill = 0
+                    batch_count = 0
             elif length < 0:
                 print(f"ALSA読み取りエラー: {length}", file=sys.stderr)
                 break
@@ -62,51 +380,71 @@ async def alsa_to_websocket(websocket, inp):
         print("クライアントが切断しました (ALSA->WS)。")
     except Exception as e:
         print(f"ALSA->WSタスクで予期せぬエラー: {e}", file=sys.stderr)
+    finally:
+        # inpを閉じる前にイベントループから外す
+        for fd in fds:
+            loop.remove_reader(fd)
 
 
-async def send_answer_after_delay(websocket, delay):
+def _answer_sent(future):
     """
-    指定された遅延の後、"ANSWER" TEXTフレームを送信するコルーチン。
+    ANSWER送信の完了コールバック。失敗していれば表示する。
     """
-    try:
-        await asyncio.sleep(delay)
-        print(f"送信 (TEXT): ANSWER (遅延 {delay}秒後)")
-        await websocket.send("ANSWER")
-    except asyncio.CancelledError:
-        # メインのハンドラが終了した際にキャンセルされる
-        print("ANSWER送信タスクがキャンセルされました。")
-    except websockets.exceptions.ConnectionClosed:
+    if future.cancelled():
+        return
+    e = future.exception()
+    if isinstance(e, websockets.exceptions.ConnectionClosed):
         print("ANSWER送信前にクライアントが切断しました。")
-    except Exception as e:
+    elif e is not None:
         print(f"ANSWER送信中にエラー: {e}", file=sys.stderr)
 
 
+def send_answer(websocket, delay, answer_tasks):
+    """
+    遅延タイマー(loop.call_later)から呼ばれ、"ANSWER" TEXTフレームを送信する。
+    送信タスクは完了するまで answer_tasks に保持する (切断時に取り消すため)。
+    """
+    print(f"送信 (TEXT): ANSWER (遅延 {delay}秒後)")
+    task = asyncio.ensure_future(websocket.send("ANSWER"))
+    answer_tasks.add(task)
+    task.add_done_callback(answer_tasks.discard)
+    task.add_done_callback(_answer_sent)
+
+
 async def websocket_to_alsa(websocket, outp):
     """
     WebSocketからバイナリデータを受信し、ALSA出力(outp)に書き込むタスク。
     MEDIA_STARTを受信したらANSWERをスケジュールする。
     """
     print("WebSocket->ALSA タスクを開始します。")
-    answer_task = None # ANSWER送信タスクを管理
+    loop = asyncio.get_running_loop()
+    answer_handle = None # ANSWER送信タイマーを管理
+    answer_tasks = set() # 送信中のANSWERタスク
+    playback = None
 
     try:
+        # 生成時に無音補填のタイマーが動き出すので、必ずfinallyで止める
+        playback = PlaybackQueue(outp, loop, PLAYBACK_QUEUE_SIZE)
+        playback.prefill_silence(PREFILL_PERIODS)
+        feed = playback.feed
+
         # WebSocketからメッセージを非同期でイテレート
         async for message in websocket:
             
             if isinstance(message, bytes):
-                # オーディオデータはALSAへ (ブロッキング)
-                await asyncio.to_thread(outp.write, message)
+                # オーディオデータはピリオドに分割してALSAへ (ノンブロッキング)
+                feed(message)
                 
             elif isinstance(message, str):
                 # TEXTデータ処理
                 print(f"受信したTEXTデータ: {message}")
                 
-                # "MEDIA_START" を受信し、まだANSWERタスクが起動していない場合
-                if message.startswith("MEDIA_START") and not answer_task:
+                # "MEDIA_START" を受信し、まだANSWERを予約していない場合
+                if not answer_handle and message.startswith("MEDIA_START"):
                     print(f"MEDIA_STARTを検出。{ANSWER_DELAY}秒後に 'ANSWER' を送信予約します。")
-                    # ANSWER送信タスクを非同期で起動 (受信ループをブロックしない)
-                    answer_task = asyncio.create_task(
-                        send_answer_after_delay(websocket, ANSWER_DELAY)
+                    # タイマーで予約する (受信ループをブロックしない)
+                    answer_handle = loop.call_later(
+                        ANSWER_DELAY, send_answer, websocket, ANSWER_DELAY, answer_tasks
                     )
             else:
                 print("不明な形式のメッセージを受信。無視します。")
@@ -116,88 +454,162 @@ async def websocket_to_alsa(websocket, outp):
     except Exception as e:
         print(f"WS->ALSAタスクで予期せぬエラー: {e}", file=sys.stderr)
     finally:
-        # このタスクが終了する際、スケジュールされたANSWERタスクが
-        # まだ実行中ならキャンセルする
-        if answer_task and not answer_task.done():
-            answer_task.cancel()
+        # このタスクが終了する際、ANSWERがまだ送信前ならタイマーと送信を取り消す
+        if answer_handle:
+            answer_handle.cancel()
+        for task in answer_tasks:
+            task.cancel()
+        # outpを閉じる前にイベントループから外す
+        if playback:
+            playback.close()
+
+
+class AudioDevices:
+    """
+    サーバ起動時に一度だけ開き、接続間で共有するALSA入出力デバイス。
+    同時に使えるのは1接続だけ (lockで排他)。
+    接続がない間はキャプチャを読み捨てて動かし続ける (プリウォーム)。
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.lock = asyncio.Lock()
+        self.inp = None
+        self.outp = None
+        try:
+            # ALSA入力デバイスを初期化
+            self.inp = alsaaudio.PCM(
+                type=alsaaudio.PCM_CAPTURE,
+                mode=alsaaudio.PCM_NONBLOCK,
+                channels=CHANNELS,
+                rate=RATE,
+                format=FORMAT,
+                periodsize=PERIOD_SIZE,
+                device=INPUT_DEVICE
+            )
+
+            # ALSA出力デバイスを初期化
+            self.outp = alsaaudio.PCM(
+                type=alsaaudio.PCM_PLAYBACK,
+                mode=alsaaudio.PCM_NONBLOCK,
+                channels=CHANNELS,
+                rate=RATE,
+                format=FORMAT,
+                periodsize=PERIOD_SIZE,
+                device=OUTPUT_DEVICE
+            )
+        except alsaaudio.ALSAAudioError:
+            self.close()
+            raise
+        self.capture_fds = [fd for fd, events in self.inp.polldescriptors()]
+        self.idle = False
+
+    def _discard_capture(self):
+        # 接続がない間のキャプチャは読み捨てる
+        while True:
+            try:
+                length, data = self.inp.read()
+            except alsaaudio.ALSAAudioError as e:
+                print(f"ALSA読み取りエラー: {e}", file=sys.stderr)
+                # 外さないと読み取り可能通知のたびに同じ例外が出続ける
+                self.stop_idle()
+                break
+            if length <= 0:
+                break
+
+    def start_idle(self):
+        """
+        接続がない間のキャプチャ読み捨てを開始する。
+        """
+        if self.idle:
+            return
+        for fd in self.capture_fds:
+            self.loop.add_reader(fd, self._discard_capture)
+        self.idle = True
+        # キャプチャは最初の読み取りで開始されるので一度呼んでおく
+        self._discard_capture()
+
+    def stop_idle(self):
+        """
+        キャプチャの読み捨てを止める (接続側のタスクが読み取りを引き継ぐ)。
+        """
+        if not self.idle:
+            return
+        for fd in self.capture_fds:
+            self.loop.remove_reader(fd)
+        self.idle = False
+
+    def close(self):
+        if self.inp:
+            self.stop_idle()
+            self.inp.close()
+        if self.outp:
+            self.outp.close()
 
 
-async def audio_handler(websocket):
+async def audio_handler(websocket, devices):
     """
     WebSocketクライアント接続時のメインハンドラ。
+    ALSAデバイスは起動時に開いたもの(devices)を使う。
     """
     print(f"クライアント {websocket.remote_address} が接続しました。")
-    inp = None
-    outp = None
-    
-    try:
-        # 1. ALSA入力デバイスを初期化
-        inp = alsaaudio.PCM(
-            type=alsaaudio.PCM_CAPTURE,
-            mode=alsaaudio.PCM_NORMAL,
-            channels=CHANNELS,
-            rate=RATE,
-            format=FORMAT,
-            periodsize=PERIOD_SIZE,
-            device=INPUT_DEVICE
-        )
-        
-        # 2. ALSA出力デバイスを初期化
-        outp = alsaaudio.PCM(
-            type=alsaaudio.PCM_PLAYBACK,
-            mode=alsaaudio.PCM_NORMAL,
-            channels=CHANNELS,
-            rate=RATE,
-            format=FORMAT,
-            periodsize=PERIOD_SIZE,
-            device=OUTPUT_DEVICE
-        )
-        print("ALSAデバイスを開きました。双方向ストリーミングを開始します。")
 
-        # 3. 2つのタスク (読み取り/書き込み) を作成
-        task_read = asyncio.create_task(alsa_to_websocket(websocket, inp))
-        task_write = asyncio.create_task(websocket_to_alsa(websocket, outp))
+    # ALSAデバイスは1つなので同時接続は受け付けない
+    if devices.lock.locked():
+        print(f"別のクライアントが使用中のため {websocket.remote_address} を拒否します。")
+        await websocket.close(1013, "audio device busy")
+        return
 
-        # 4. どちらかのタスクが終了するまで待機 (切断時など)
-        done, pending = await asyncio.wait(
-            [task_read, task_write],
-            return_when=asyncio.FIRST_COMPLETED,
-        )
+    async with devices.lock:
+        devices.stop_idle()
+        try:
+            print("双方向ストリーミングを開始します。")
 
-        # 5. 残ったタスクをキャンセル
-        for task in pending:
-            task.cancel()
+            # 1. 2つのタスク (読み取り/書き込み) を実行し、
+            #    どちらかが終了したら (切断時など) もう一方も止める
+            await run_until_first_done(
+                alsa_to_websocket(websocket, devices.inp),
+                websocket_to_alsa(websocket, devices.outp),
+            )
 
-    except alsaaudio.ALSAAudioError as e:
-        print(f"ALSA初期化エラー: {e}", file=sys.stderr)
-        print("デバイスがビジーか、設定がサポートされていません。")
-    except Exception as e:
-        print(f"ハンドラで予期せぬエラー: {e}", file=sys.stderr)
-        
-    finally:
-        # 6. クリーンアップ
-        if inp:
-            inp.close()
-        if outp:
-            outp.close()
-        print(f"クライアント {websocket.remote_address} との接続を終了。ALSAデバイスを閉じました。")
+        except Exception as e:
+            print(f"ハンドラで予期せぬエラー: {e}", file=sys.stderr)
+
+        finally:
+            # 2. 次の接続まで再びキャプチャを読み捨てる (デバイスは閉じない)
+            devices.start_idle()
+            print(f"クライアント {websocket.remote_address} との接続を終了しました。")
 
 
 async def main():
     """
     WebSocketサーバを起動するメイン関数。
     """
-    print(f"WebSocketサーバを ws://{WEBSOCKET_HOST}:{WEBSOCKET_PORT} で起動します...")
-    print("Ctrl+C で停止します。")
+    # 指定があればALSAの読み書きを行うこのスレッド(イベントループ)の優先度を上げる
+    set_audio_scheduling()
+
+    # ALSAデバイスは接続ごとに開かず、ここで一度だけ開いて共有する
+    try:
+        devices = AudioDevices(asyncio.get_running_loop())
+    except alsaaudio.ALSAAudioError as e:
+        print(f"ALSA初期化エラー: {e}", file=sys.stderr)
+        print("デバイスがビジーか、設定がサポートされていません。")
+        return
+    devices.start_idle()
+    print("ALSAデバイスを開きました。")
     
-    async with websockets.serve(audio_handler, WEBSOCKET_HOST, WEBSOCKET_PORT):
-        await asyncio.Future()  # 永久に実行
+    try:
+        await serve_forever(
+            functools.partial(audio_handler, devices=devices),
+            WEBSOCKET_HOST,
+            WEBSOCKET_PORT,
+            socket_buffer_size=SOCKET_BUFFER_SIZE,
+            write_limit=WRITE_LIMIT,
+        )
+    finally:
+        devices.close()
+        print("ALSAデバイスを閉じました。")
 
 if __name__ == "__main__":
-    if sys.version_info < (3, 9):
-        print("このスクリプトは Python 3.9 以上 (asyncio.to_thread) が必要です。")
-    else:
-        try:
-            asyncio.run(main())
-        except KeyboardInterrupt:
-            print("\nサーバを停止します。")
+    # ALSAデバイスは1つなので単一プロセスで動かす
+    run(main)
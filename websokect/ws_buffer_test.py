@@ -1,11 +1,14 @@
 #!/usr/bin/env python3
 # venv環境 (source venv/bin/activate) で実行
-# pip install --upgrade pyalsaaudio websockets
+# pip install --upgrade pyalsaaudio "websockets>=14" uvloop
 
 import asyncio
+import os
 import websockets
 import sys
 
+from ws_core import run_until_first_done, serve
+
 # --- 設定 ---
 WEBSOCKET_HOST = '0.0.0.0' # すべてのIFで待ち受け
 WEBSOCKET_PORT = 8765      # 待ち受けポート
@@ -17,15 +20,45 @@ AUDIO_FILE = 'output.slin16'
 # 16kHz, 20ms のチャンクサイズ
 # 16000 [サンプル/秒] * 0.020 [秒] = 320 [サンプル]
 # 320 [サンプル] * 2 [バイト/サンプル] = 640 [バイト]
-# 1パケット(1チャンク単位送り付けの場合)
-#CHUNK_SIZE = 640
-# 100パケット送り付け例
-CHUNK_SIZE = 64000
+PERIOD_BYTES = 640
+# 何パケット分をまとめて1フレームで送るか (環境変数 WS_BATCH で指定)
+# 1パケット(1チャンク単位送り付けの場合): WS_BATCH=1
+# 100パケット送り付け例 (デフォルト)
+BATCH_PERIODS = max(1, int(os.getenv("WS_BATCH", "100")))
+CHUNK_SIZE = PERIOD_BYTES * BATCH_PERIODS
+
+# ワーカープロセス数 (環境変数 WS_WORKERS で指定, 0 ならCPU数)
+# 2以上の場合はSO_REUSEPORTで同じポートを複数プロセスで待ち受け、
+# カーネルに接続を振り分けさせる
+WORKERS = int(os.getenv("WS_WORKERS", "1")) or os.cpu_count()
+
+
+def _load_audio_chunks(path):
+    """
+    オーディオファイルを一度だけ読み込み、CHUNK_SIZEごとのビューのリストを返す。
+    ファイルがなければ None を返す。
+    """
+    try:
+        with open(path, 'rb') as f:
+            blob = f.read()
+    except FileNotFoundError:
+        return None
+    mv = memoryview(blob)
+    return [mv[i:i + CHUNK_SIZE] for i in range(0, len(blob), CHUNK_SIZE)]
+
+
+# 全接続で同じファイルを送るので起動時に読み込んでおく
+AUDIO_CHUNKS = _load_audio_chunks(AUDIO_FILE)
 
 print("--- バッファリングモード テストサーバ ---")
 print(f"ファイル: {AUDIO_FILE}")
 print(f"チャンクサイズ: {CHUNK_SIZE} バイト")
+if AUDIO_CHUNKS is None:
+    print(f"警告: ファイル '{AUDIO_FILE}' が見つかりません。", file=sys.stderr)
+else:
+    print(f"チャンク数: {len(AUDIO_CHUNKS)}")
 print(f"サーバ: ws://{WEBSOCKET_HOST}:{WEBSOCKET_PORT}")
+print(f"ワーカー数: {WORKERS}")
 print("-" * 22)
 
 
@@ -37,10 +70,16 @@ async def handle_incoming(websocket, can_send_event):
     print("[IN]  受信タスクを開始しました。")
     try:
         async for message in websocket:
-            if isinstance(message, str):
+            # 受信の大半は音声なのでBINARYを先に判定する
+            if isinstance(message, bytes):
+                # --- BINARY (音声) データ処理 ---
+                # 受信した音声データは読み捨てる
+                pass
+
+            elif isinstance(message, str):
                 # --- TEXTメッセージ処理 ---
                 print(f"[IN]  受信 (TEXT): {message.strip()}")
-                
+
                 if message == "MEDIA_XOFF":
                     print("[IN]  フロー制御: PAUSE (MEDIA_XOFF)")
                     can_send_event.clear()  # 送信タスクを一時停止
@@ -49,11 +88,6 @@ async def handle_incoming(websocket, can_send_event):
                     print("[IN]  フロー制御: RESUME (MEDIA_XON)")
                     can_send_event.set()    # 送信タスクを再開
                 
-            elif isinstance(message, bytes):
-                # --- BINARY (音声) データ処理 ---
-                # 受信した音声データは読み捨てる
-                pass
-                
     except websockets.exceptions.ConnectionClosed:
         print("[IN]  クライアントが切断しました。")
     except Exception as e:
@@ -75,28 +109,23 @@ async def send_audio_file(websocket, can_send_event):
         print("[OUT] 送信 (TEXT): START_MEDIA_BUFFERING")
         await websocket.send("START_MEDIA_BUFFERING")
 
-        # 2. オーディオファイルを開いて送信ループ開始
-        with open(AUDIO_FILE, 'rb') as f:
-            while True:
-                # 3. フロー制御イベントを待機 (XOFFならここでブロック)
-                await can_send_event.wait()
-                
-                # 4. ファイルから1チャンク読み込み
-                data = f.read(CHUNK_SIZE)
-                
-                if not data:
-                    # ファイル終端
-                    print("[OUT] ファイルの送信が完了しました。")
-                    break
-                
-                # 5. データを送信
-                await websocket.send(data)
-                
-                # (重要) Asteriskのキューを溢れさせないよう、
-                # チャンク送信ごとに少しだけイベントループに制御を戻す
-                await asyncio.sleep(0) 
+        # 2. 起動時に読み込んだチャンクを順に送信
+        if AUDIO_CHUNKS is None:
+            raise FileNotFoundError(AUDIO_FILE)
+
+        for chunk in AUDIO_CHUNKS:
+            # 3. フロー制御イベントを待機 (XOFFならここでブロック)
+            await can_send_event.wait()
 
-        # 6. バッファリング終了を通知
+            # 4. データを送信
+            # 送信バッファが write_limit の上限を超えている間は
+            # send() 内で待たされる (これがバックプレッシャーになる)
+            await websocket.send(chunk)
+
+        # ファイル終端
+        print("[OUT] ファイルの送信が完了しました。")
+
+        # 5. バッファリング終了を通知
         print("[OUT] 送信 (TEXT): STOP_MEDIA_BUFFERING")
         await websocket.send("STOP_MEDIA_BUFFERING")
 
@@ -118,38 +147,22 @@ async def audio_handler(websocket):
     can_send_event = asyncio.Event()
     can_send_event.set()
 
-    # 3. 2つのタスク (読み取り/書き込み) を作成
-    task_read = asyncio.create_task(handle_incoming(websocket, can_send_event))
-    task_write = asyncio.create_task(send_audio_file(websocket, can_send_event))
-
-    # 4. どちらかのタスクが終了するまで待機 (切断時など)
-    done, pending = await asyncio.wait(
-        [task_read, task_write],
-        return_when=asyncio.FIRST_COMPLETED,
+    # 3. 2つのタスク (読み取り/書き込み) を実行し、
+    #    どちらかが終了したら (切断時など) もう一方も止める
+    await run_until_first_done(
+        handle_incoming(websocket, can_send_event),
+        send_audio_file(websocket, can_send_event),
     )
 
-    # 5. 残ったタスクをキャンセル
-    for task in pending:
-        task.cancel()
-            
     print(f"クライアント {websocket.remote_address} との接続を終了しました。")
 
 
-async def main():
-    """
-    WebSocketサーバを起動するメイン関数。
-    """
-    print(f"WebSocketサーバを ws://{WEBSOCKET_HOST}:{WEBSOCKET_PORT} で起動します...")
-    print("Ctrl+C で停止します。")
-    
-    async with websockets.serve(audio_handler, WEBSOCKET_HOST, WEBSOCKET_PORT):
-        await asyncio.Future()  # 永久に実行
-
 if __name__ == "__main__":
-    if sys.version_info < (3, 9):
-        print("このスクリプトは Python 3.9 以上 (asyncio.to_thread) が必要です。")
-    else:
-        try:
-            asyncio.run(main())
-        except KeyboardInterrupt:
-            print("\nサーバを停止します。")
+    # write_limit は送信バッファの (上限, 下限)。上限を超えると send() が待つ。
+    serve(
+        WEBSOCKET_HOST,
+        WEBSOCKET_PORT,
+        audio_handler,
+        workers=WORKERS,
+        write_limit=(2**15, 2**14),
+    )
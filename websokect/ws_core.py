@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# WebSocketサーバ共通部分
+# ws_audio_server.py / ws_buffer_test.py / ws_echo.py から import して使う
+# pip install --upgrade "websockets>=14" uvloop
+
+import asyncio
+import os
+import socket
+import sys
+import time
+import traceback
+import websockets
+
+try:
+    # あれば uvloop (libuvベースのイベントループ) を使う
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# ソケットの送受信バッファサイズ (デフォルト)
+SOCKET_BUFFER_SIZE = 65536
+
+# websockets.serve に渡す共通オプション (serve_forever の引数で上書きできる)
+# PCMはBINARY(opcode 0x2)フレームで送受信するのでUTF-8検証は行われない。
+# 非圧縮のPCMにdeflateをかけてもCPUの無駄なので圧縮は無効にする。
+# max_size (受信フレームの上限) はライブラリのデフォルト (1MiB) のままにする。
+SERVE_OPTIONS = dict(
+    compression=None,
+    write_limit=2**16,
+)
+
+
+def tune_sock(sock, buffer_size=SOCKET_BUFFER_SIZE):
+    """
+    接続ソケットのNagleを無効にして即時に送るようにし、送受信バッファを固定する。
+    """
+    if sock is not None:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, buffer_size)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+
+
+def make_socket_tuner(buffer_size=SOCKET_BUFFER_SIZE):
+    """
+    websockets.serve の process_request に渡す関数を返す。
+    ハンドシェイク時に接続ソケットを設定し、None を返してそのまま続行する。
+    """
+    def tune_socket(connection, request):
+        tune_sock(connection.transport.get_extra_info("socket"), buffer_size)
+        return None
+    return tune_socket
+
+
+async def run_until_first_done(*coros):
+    """
+    複数のコルーチンをTaskGroupで並行に実行し、どれか1つが終了したら残りを止める。
+    TaskGroupを抜ける時点ですべての終了が保証される。
+    """
+    stop_evt = asyncio.Event()
+
+    async def _run(coro):
+        try:
+            await coro
+        finally:
+            stop_evt.set()
+
+    async with asyncio.TaskGroup() as tg:
+        tasks = [tg.create_task(_run(coro)) for coro in coros]
+
+        # どれかのタスクが終了するまで待機 (切断時など)
+        await stop_evt.wait()
+
+        # 残ったタスクを止める
+        for task in tasks:
+            task.cancel()
+
+
+async def serve_forever(handler, host, port, *,
+                        socket_buffer_size=SOCKET_BUFFER_SIZE,
+                        reuse_port=False, **kwargs):
+    """
+    共通オプションでWebSocketサーバを起動し、停止されるまで動かす。
+    kwargs は SERVE_OPTIONS を上書きして websockets.serve に渡す。
+    """
+    print(f"WebSocketサーバを ws://{host}:{port} で起動します...")
+    print("Ctrl+C で停止します。")
+
+    options = dict(
+        SERVE_OPTIONS,
+        process_request=make_socket_tuner(socket_buffer_size),
+        reuse_port=reuse_port,
+    )
+    options.update(kwargs)
+    async with websockets.serve(handler, host, port, **options):
+        await asyncio.Future()  # 永久に実行
+
+
+def run_main(main):
+    """
+    main() をイベントループで実行する。uvloopがあればそのループを使う。
+    """
+    loop_factory = uvloop.new_event_loop if uvloop else None
+    with asyncio.Runner(loop_factory=loop_factory) as runner:
+        runner.run(main())
+
+
+def run_workers(main, n):
+    """
+    n個のワーカープロセスをforkしてそれぞれで main() を動かす。
+    異常終了したワーカーは再起動する。
+    """
+    children = set()
+
+    def spawn():
+        # 親のバッファに残った出力が子にコピーされて二重に出ないようにする
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            # --- 子プロセス ---
+            code = 0
+            try:
+                run_main(main)
+            except KeyboardInterrupt:
+                pass
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            # os._exit はバッファを書き出さずに終了するので先に出力しておく
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+        children.add(pid)
+
+    for _ in range(n):
+        spawn()
+    print(f"{n} 個のワーカープロセスを起動しました。")
+
+    try:
+        while children:
+            pid, status = os.wait()
+            children.discard(pid)
+            code = os.waitstatus_to_exitcode(status)
+            if code != 0:
+                print(f"ワーカー {pid} が異常終了しました ({code})。再起動します。", file=sys.stderr)
+                time.sleep(1.0)  # 即死を繰り返す場合に備えて少し待つ
+                spawn()
+    except KeyboardInterrupt:
+        # Ctrl+C は子プロセスにも届くので終了を待つ
+        for pid in children:
+            os.waitpid(pid, 0)
+
+
+def run(main, workers=1):
+    """
+    スクリプトの入口。uvloopがあれば使い、main() を実行する。
+    workers が2以上なら run_workers で複数プロセスにする。
+    """
+    if sys.version_info < (3, 11):
+        print("このスクリプトは Python 3.11 以上 (asyncio.TaskGroup) が必要です。")
+        return
+    try:
+        if workers > 1:
+            run_workers(main, workers)
+        else:
+            run_main(main)
+    except KeyboardInterrupt:
+        pass
+    print("\nサーバを停止します。")
+
+
+def serve(host, port, handler, workers=1, **kwargs):
+    """
+    ハンドラを定義するだけのスクリプト用。サーバを起動して停止されるまで動かす。
+    kwargs は serve_forever に渡す。
+    """
+    async def main():
+        await serve_forever(handler, host, port, reuse_port=workers > 1, **kwargs)
+
+    run(main, workers)
@@ -1,17 +1,47 @@
 #!/usr/bin/env python3
 # venv環境 (source venv/bin/activate) で実行
-# pip install --upgrade websockets
+# pip install --upgrade "websockets>=14" uvloop
 
 import asyncio
+import base64
+import functools
+import hashlib
+import os
 import websockets
 import sys
 
+from ws_core import run, serve_forever, tune_sock
+
 # --- WebSocketサーバ設定 ---
 WEBSOCKET_HOST = '0.0.0.0' # すべてのIFで待ち受け
 WEBSOCKET_PORT = 8765      # 待ち受けポート
 
+# WS_ECHO_BROADCAST=1 の場合、受信したBINARYを接続中の全クライアントに送る
+# (websockets.broadcast はフレームを一度だけ組み立てて各接続に書き込む)
+# broadcast は送信バッファの空きを待たないので、遅いクライアントにはバッファが溜まる
+ECHO_BROADCAST = os.getenv("WS_ECHO_BROADCAST", "0") == "1"
+
+# WS_ECHO_RAW=1 の場合、websockets を使わず asyncio.Protocol で
+# RFC 6455 の最低限 (ハンドシェイクとフレーム処理) だけを実装したエコーで動かす
+# (このモードではブロードキャストは使えない)
+ECHO_RAW = os.getenv("WS_ECHO_RAW", "0") == "1"
+# RAWモードで受け付ける1フレームの最大ペイロード長
+RAW_MAX_PAYLOAD = 2**20
+
+# 接続中のクライアント (ブロードキャスト用)
+# 複数ワーカー時は同じプロセスに接続したクライアントにのみ届く
+CLIENTS = set()
+
+# ワーカープロセス数 (環境変数 WS_WORKERS で指定, 0 ならCPU数)
+# 2以上の場合はSO_REUSEPORTで同じポートを複数プロセスで待ち受け、
+# カーネルに接続を振り分けさせる
+WORKERS = int(os.getenv("WS_WORKERS", "1")) or os.cpu_count()
+
 print("--- WebSocket エコーサーバ ---")
 print(f"サーバ: ws://{WEBSOCKET_HOST}:{WEBSOCKET_PORT}")
+print(f"ワーカー数: {WORKERS}")
+print(f"ブロードキャスト: {'有効' if ECHO_BROADCAST else '無効'}")
+print(f"RAWモード: {'有効' if ECHO_RAW else '無効'}")
 print("-" * 22)
 
 async def echo_handler(websocket):
@@ -20,19 +50,25 @@ async def echo_handler(websocket):
     TEXTはprintし、BINARY(音声)はそのままエコーバックする。
     """
     print(f"クライアント {websocket.remote_address} が接続しました。")
+    CLIENTS.add(websocket)
     
     try:
         # 接続されたクライアントからのメッセージを非同期で待機
         async for message in websocket:
             
-            if isinstance(message, str):
-                # 1. TEXTデータが送られてきた場合
-                print(f"受信 (TEXT): {message.strip()}")
+            # 受信の大半は音声なのでBINARYを先に判定する
+            if isinstance(message, bytes):
+                # 1. BINARY (音声) データが送られてきた場合
+                if ECHO_BROADCAST:
+                    # 全クライアントへ送る (フレーム化は一度だけ)
+                    websockets.broadcast(CLIENTS, message)
+                else:
+                    # 受信したbytesをそのまま同じ接続先に送り返す (エコーバック)
+                    await websocket.send(message)
             
-            elif isinstance(message, bytes):
-                # 2. BINARY (音声) データが送られてきた場合
-                # そのまま同じ接続先に送り返す (エコーバック)
-                await websocket.send(message)
+            elif isinstance(message, str):
+                # 2. TEXTデータが送られてきた場合
+                print(f"受信 (TEXT): {message.strip()}")
             
             else:
                 print("不明な形式のメッセージを受信。無視します。")
@@ -42,20 +78,218 @@ async def echo_handler(websocket):
     except Exception as e:
         print(f"ハンドラで予期せぬエラー: {e}", file=sys.stderr)
     finally:
+        CLIENTS.discard(websocket)
         print(f"クライアント {websocket.remote_address} との接続を終了しました。")
 
 
+# --- RAWモード (asyncio.Protocol による最小限のWebSocket実装) ---
+WS_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+OP_CONT = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+FIN = 0x80
+
+
+@functools.lru_cache(maxsize=64)
+def _frame_header(b0, length):
+    """
+    サーバ->クライアント(マスクなし)のフレームヘッダを返す。
+    音声はほぼ同じ長さなので、組み立て済みのヘッダをキャッシュから使い回す。
+    """
+    if length < 126:
+        return bytes((b0, length))
+    if length < 0x10000:
+        return bytes((b0, 126)) + length.to_bytes(2, "big")
+    return bytes((b0, 127)) + length.to_bytes(8, "big")
+
+
+def _unmask(payload, mask):
+    """
+    クライアントからのペイロードのマスクを外す。
+    1バイトずつではなく整数のXORとしてまとめて処理する。
+    """
+    length = len(payload)
+    key = (mask * (length // 4 + 1))[:length]
+    value = int.from_bytes(payload, "little") ^ int.from_bytes(key, "little")
+    return value.to_bytes(length, "little")
+
+
+class RawEchoProtocol(asyncio.Protocol):
+    """
+    RFC 6455 のハンドシェイクとフレーム処理だけを行うエコーサーバ。
+    BINARYはヘッダとペイロードを結合せずに writelines で送り返す。
+    TEXTはprintする。
+    """
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.peer = transport.get_extra_info("peername")
+        self.buf = bytearray()
+        self.handshaken = False
+        self.closing = False
+        self.fragment_opcode = None
+        self.text_parts = []
+        tune_sock(transport.get_extra_info("socket"))
+        print(f"クライアント {self.peer} が接続しました。(RAW)")
+
+    def connection_lost(self, exc):
+        print(f"クライアント {self.peer} との接続を終了しました。")
+
+    def pause_writing(self):
+        # 送信バッファが上限を超えたら、減るまで受信 (=エコーの発生) を止める
+        if not self.transport.is_closing():
+            self.transport.pause_reading()
+
+    def resume_writing(self):
+        if not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def data_received(self, data):
+        self.buf += data
+        if not self.handshaken and not self._handshake():
+            return
+        self._process_frames()
+
+    def _handshake(self):
+        """
+        HTTPのUpgrade要求を読み、101応答を返す。完了したら True を返す。
+        """
+        end = self.buf.find(b"\r\n\r\n")
+        if end < 0:
+            if len(self.buf) > 8192:
+                self.transport.close()
+            return False
+        request = bytes(self.buf[:end]).decode("latin-1")
+        del self.buf[:end + 4]
+
+        key = None
+        for line in request.split("\r\n")[1:]:
+            name, _, value = line.partition(":")
+            if name.strip().lower() == "sec-websocket-key":
+                key = value.strip()
+        if not key:
+            self.transport.write(b"HTTP/1.1 400 Bad Request\r\n\r\n")
+            self.transport.close()
+            return False
+
+        accept = base64.b64encode(hashlib.sha1(key.encode() + WS_GUID).digest())
+        self.transport.write(
+            b"HTTP/1.1 101 Switching Protocols\r\n"
+            b"Upgrade: websocket\r\n"
+            b"Connection: Upgrade\r\n"
+            b"Sec-WebSocket-Accept: " + accept + b"\r\n\r\n"
+        )
+        self.handshaken = True
+        return True
+
+    def _process_frames(self):
+        """
+        バッファ内の完全なフレームをすべて処理する。
+        """
+        buf = self.buf
+        size = len(buf)
+        pos = 0
+        # バッファはmemoryviewで切り出してコピーせずに読む
+        # (del で詰める前にビューを解放する必要があるのでwithで囲む)
+        with memoryview(buf) as view:
+            while size - pos >= 2 and not self.closing:
+                b0 = view[pos]
+                b1 = view[pos + 1]
+                length = b1 & 0x7F
+                hlen = 2
+                if length == 126:
+                    if size - pos < 4:
+                        break
+                    length = int.from_bytes(view[pos + 2:pos + 4], "big")
+                    hlen = 4
+                elif length == 127:
+                    if size - pos < 10:
+                        break
+                    length = int.from_bytes(view[pos + 2:pos + 10], "big")
+                    hlen = 10
+                if length > RAW_MAX_PAYLOAD:
+                    # 1009: Message Too Big
+                    self._close(1009)
+                    break
+                masked = b1 & 0x80
+                if masked:
+                    hlen += 4
+                if size - pos < hlen + length:
+                    break
+
+                start = pos + hlen
+                if masked and length:
+                    # マスク解除の結果は新しいbytesになる
+                    payload = _unmask(view[start:start + length], bytes(view[start - 4:start]))
+                else:
+                    payload = bytes(view[start:start + length])
+                pos = start + length
+                self._handle_frame(b0, payload)
+        del buf[:pos]
+
+    def _handle_frame(self, b0, payload):
+        opcode = b0 & 0x0F
+        fin = b0 & FIN
+
+        if opcode == OP_CONT:
+            opcode = self.fragment_opcode
+            if fin:
+                self.fragment_opcode = None
+        elif opcode in (OP_TEXT, OP_BINARY) and not fin:
+            self.fragment_opcode = opcode
+
+        if opcode == OP_BINARY:
+            # BINARY (音声) はFIN/opcodeをそのままにエコーバック
+            # ヘッダとペイロードは結合せず1回のwritelinesで送る
+            self.transport.writelines([_frame_header(b0, len(payload)), payload])
+        elif opcode == OP_TEXT:
+            self.text_parts.append(payload)
+            if fin:
+                message = b"".join(self.text_parts).decode("utf-8", "replace")
+                self.text_parts = []
+                print(f"受信 (TEXT): {message.strip()}")
+        elif b0 & 0x0F == OP_PING:
+            self.transport.writelines([_frame_header(FIN | OP_PONG, len(payload)), payload])
+        elif b0 & 0x0F == OP_CLOSE:
+            code = int.from_bytes(payload[:2], "big") if len(payload) >= 2 else 1000
+            self._close(code)
+
+    def _close(self, code):
+        # CLOSEフレームを返して切断する
+        self.closing = True
+        self.transport.write(_frame_header(FIN | OP_CLOSE, 2) + code.to_bytes(2, "big"))
+        self.transport.close()
+
+
 async def main():
     """
     WebSocketサーバを起動するメイン関数。
     """
-    print("Ctrl+C で停止します。")
-    
-    async with websockets.serve(echo_handler, WEBSOCKET_HOST, WEBSOCKET_PORT):
-        await asyncio.Future()  # 実行を継続
+    if ECHO_RAW:
+        print(f"RAWモードで ws://{WEBSOCKET_HOST}:{WEBSOCKET_PORT} を起動します...")
+        print("Ctrl+C で停止します。")
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(
+            RawEchoProtocol,
+            WEBSOCKET_HOST,
+            WEBSOCKET_PORT,
+            reuse_port=WORKERS > 1,
+        )
+        async with server:
+            await server.serve_forever()
+        return
+
+    await serve_forever(
+        echo_handler,
+        WEBSOCKET_HOST,
+        WEBSOCKET_PORT,
+        reuse_port=WORKERS > 1,
+    )
+
 
 if __name__ == "__main__":
-    try:
-        asyncio.run(main())
-    except KeyboardInterrupt:
-        print("\nサーバを停止します。")
+    run(main, WORKERS)